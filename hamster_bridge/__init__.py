@@ -30,8 +30,8 @@ def main():
     parser = argparse.ArgumentParser(description='Let your hamster log your work to your favorite bugtracker.')
     parser.add_argument('bugtracker', choices=sorted(listener_choices.keys()))
     parser.add_argument('-d', '--debug', action='store_true', help='enable debug logging')
-    parser.add_argument('-c', '--check-interval', default='2', type=int,
-                        help='check every this amount of seconds for updates')
+    parser.add_argument('-c', '--check-interval', default='30', type=int,
+                        help='check every this amount of seconds for updates hamster did not notify about')
     parser.add_argument('--config-path', default=CONFIG_PATH, type=str, 
                         help='path to config file, defaults to {}'.format(CONFIG_PATH))
     parser.add_argument('--save-passwords', action='store_true',
@@ -1,9 +1,11 @@
 import ConfigParser
 import datetime
-import time
 import logging
 import os
+import Queue
 import stat
+import threading
+from StringIO import StringIO
 
 logger = logging.getLogger(__name__)
 
@@ -13,37 +15,44 @@ try:
 except ImportError:
     raise ImportError('Can not find hamster')
 
+try:
+    import gobject
+except ImportError:
+    from gi.repository import GObject as gobject
 
-def _combine_configs(*configs):
-    """
-    Combines all configs (instances of RawConfigParser) into a single one
-    containing all sections and values. If duplicates appear the later configs
-    will overwrite the earlier values.
-    Returns a RawConfigParser() instance.
-    """
-    result = ConfigParser.RawConfigParser()
-    for config in configs:
-        for section in config.sections():
-            try:
-                result.add_section(section)
-            except ConfigParser.DuplicateSectionError:
-                # Ignore it. We simply want to include all sections from
-                # the source configs
-                pass
-            for option in config.options(section):
-                value = config.get(section, option)
-                result.set(section, option, value)
-    return result
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+
+# hamster's dbus signals are only delivered if the session bus, created by hamster.client.Storage.__init__(), is
+# attached to the glib main loop run by the bridge
+DBusGMainLoop(set_as_default=True)
+
+
+# upper limit in seconds for backing off the polling while no facts change
+MAX_POLLING_INTERVALL = 300
+
+# check windows up to this length, like the re-check after a change notification, only query today's facts
+SHORT_CHECK_WINDOW = datetime.timedelta(seconds=2)
 
 
 class HamsterBridge(hamster.client.Storage):
     """
-    Connects to the running hamster instance via dbus. But as the notification does not work reliable there is a
-    polling-based loop in the run()-method that will trigger all registered listeners.
+    Connects to the running hamster instance via dbus. Changes notified by hamster trigger a check of the facts right
+    away. But as the notification does not work reliable there is an additional polling-based fallback in the
+    run()-method's main loop. Both will trigger all registered listeners, which are called from a background thread
+    so talking to a slow bugtracker does not block the checks.
     """
     def __init__(self, save_passwords=False):
         super(HamsterBridge, self).__init__()
         self._listeners = []
+        self._last_check = None
+        # the configured polling intervall, the current (backed off) one and its gobject timeout source
+        self._base_polling_intervall = None
+        self._polling_intervall = None
+        self._polling_source = None
+        # queued (listener method name, fact) tuples, None stops the worker
+        self._events = Queue.Queue()
+        self._worker = None
         self.save_passwords = save_passwords
 
     def add_listener(self, listener):
@@ -73,23 +82,167 @@ class HamsterBridge(hamster.client.Storage):
         for listener in self._listeners:
             logger.debug('Configuring listener %s', listener)
             listener.configure(config, sensitive_config)
-        # save to file
-        with open(path, 'wb') as configfile:
-            logger.debug('Writing back configuration to %s', path)
-            if self.save_passwords:
-                all_configs = _combine_configs(config, sensitive_config)
-                all_configs.write(configfile)
-            else:
-                config.write(configfile)
-        # as we store passwords in clear text, let's at least set correct file permissions
-        logger.debug('Setting owner only file permissions to %s', path)
-        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR)
-
-    def run(self, polling_intervall=1):
-        """
-        Starts the polling loop that will run until receive common exit signals.
-
-        :param polling_intervall: how often the connector polls data from haster in seconds (default: 1)
+        # render the config in memory to write it back with a single write call
+        if self.save_passwords:
+            # merge the sensitive values into the config to write
+            for section in sensitive_config.sections():
+                if not config.has_section(section):
+                    config.add_section(section)
+                for option, value in sensitive_config.items(section):
+                    config.set(section, option, value)
+        buf = StringIO()
+        config.write(buf)
+        # save to file, as we store passwords in clear text, let's at least set correct file permissions
+        logger.debug('Writing back configuration with owner only file permissions to %s', path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IRUSR | stat.S_IWUSR)
+        with os.fdopen(fd, 'wb') as configfile:
+            # the mode above is only applied to newly created files
+            os.fchmod(fd, stat.S_IRUSR | stat.S_IWUSR)
+            configfile.write(buf.getvalue())
+            configfile.flush()
+            os.fsync(fd)
+
+    def process(self):
+        """
+        Checks for facts started or stopped since the last check and notifies all registered listeners about them.
+
+        :returns: whether a started or stopped fact was found
+        :rtype: bool
+        """
+        found = False
+        now = datetime.datetime.now().replace(microsecond=0)
+        last = self._last_check if self._last_check is not None else now
+        if now - last <= SHORT_CHECK_WINDOW:
+            facts = self.get_todays_facts()
+        else:
+            # hamster's days begin at its configured day start instead of midnight, so a longer window may reach
+            # back into the previous hamster day whose facts get_todays_facts() does no longer return
+            facts = self.get_facts(last.date() - datetime.timedelta(days=1), now.date())
+        # only now the window is checked, if querying hamster failed the next check covers it again
+        self._last_check = now
+        for fact in facts:
+            if fact.start_time is not None and last <= fact.start_time < now:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Found a started task: %r', vars(fact))
+                self._events.put(('on_fact_started', fact))
+                found = True
+            if fact.end_time is not None and last <= fact.end_time < now:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Found a stopped task: %r', vars(fact))
+                self._events.put(('on_fact_stopped', fact))
+                found = True
+        return found
+
+    def _notify_listeners(self):
+        """
+        Worker loop notifying all registered listeners about the queued events until it receives None.
+        Events queued meanwhile are handled in one go after each wake-up.
+        """
+        while True:
+            batch = [self._events.get()]
+            while True:
+                try:
+                    batch.append(self._events.get_nowait())
+                except Queue.Empty:
+                    break
+            for event in batch:
+                if event is None:
+                    return
+                method_name, fact = event
+                for listener in self._listeners:
+                    try:
+                        getattr(listener, method_name)(fact)
+                    except Exception:
+                        logger.exception('Listener %s failed handling %s', listener, method_name)
+
+    def _schedule_polling(self, polling_intervall):
+        """
+        (Re)schedules the polling fallback with the given intervall.
+
+        :param polling_intervall: seconds until the next poll
+        :type  polling_intervall: int
+        """
+        if self._polling_source is not None:
+            gobject.source_remove(self._polling_source)
+        self._polling_intervall = polling_intervall
+        self._polling_source = gobject.timeout_add_seconds(polling_intervall, self._on_polling_timeout)
+
+    def _check(self):
+        """
+        Runs process() from a gobject callback. Exceptions escaping there would only be printed by pygobject and
+        remove timeout sources, so dbus errors are logged instead and the check is repeated by the next one.
+
+        :returns: whether a started or stopped fact was found, None if hamster could not be queried
+        :rtype: bool
+        """
+        try:
+            return self.process()
+        except dbus.exceptions.DBusException:
+            logger.exception('Unable to query facts from hamster, will retry with the next check')
+            return None
+
+    def _on_hamster_facts_changed(self, storage):
+        """
+        Checks the facts when hamster notifies about changes and schedules a re-check shortly after.
+        The notification arrives within the second the fact was started or stopped, which the current check window
+        does not include yet as hamster stores the times with second precision.
+
+        :param storage: the storage emitting the signal, i.e. the bridge itself
+        :type  storage: HamsterBridge
+        """
+        logger.debug('Hamster notified about changed facts')
+        self._check()
+        gobject.timeout_add(1000, self._on_recheck_timeout)
+        # there is activity, so poll frequently again
+        if self._polling_intervall != self._base_polling_intervall:
+            self._schedule_polling(self._base_polling_intervall)
+
+    def _on_recheck_timeout(self):
+        """
+        Checks the facts once more after a change notification, covering the second the notification arrived in.
+
+        :returns: False to remove the one-shot timeout source
+        :rtype: bool
+        """
+        self._check()
+        return False
+
+    def _on_polling_timeout(self):
+        """
+        Polls the facts as fallback for lost change notifications. Doubles the polling intervall while nothing
+        changes, up to MAX_POLLING_INTERVALL, and resets it to the configured one once facts are found.
+
+        :returns: True to keep the timeout source, False if it got replaced by one with a different intervall
+        :rtype: bool
+        """
+        found = self._check()
+        if found is None:
+            # querying hamster failed, keep the intervall and retry
+            return True
+        if found:
+            polling_intervall = self._base_polling_intervall
+        else:
+            # nothing changed, double the intervall up to the limit
+            polling_intervall = min(
+                self._polling_intervall * 2,
+                max(self._base_polling_intervall, MAX_POLLING_INTERVALL),
+            )
+        if polling_intervall == self._polling_intervall:
+            # keep the timeout source alive
+            return True
+        logger.debug('Polling every %ds', polling_intervall)
+        # returning False removes the current timeout source
+        self._polling_source = None
+        self._schedule_polling(polling_intervall)
+        return False
+
+    def run(self, polling_intervall=30):
+        """
+        Starts the main loop that will run until receive common exit signals.
+
+        :param polling_intervall: how often the connector polls data from hamster in seconds in case a change
+                                  notification got lost (default: 30), doubled while nothing changes up to
+                                  MAX_POLLING_INTERVALL
         :type  polling_intervall: int
         """
         try:
@@ -97,19 +250,25 @@ class HamsterBridge(hamster.client.Storage):
                 logger.debug('Preparing listener %s', listener)
                 listener.prepare()
             logger.info('Start listening for hamster activity...')
-            now = datetime.datetime.now().replace(microsecond=0)
-            while True:
-                last = now
-                now = datetime.datetime.now().replace(microsecond=0)
-                for fact in self.get_todays_facts():
-                    if fact.start_time is not None and last <= fact.start_time < now:
-                        logger.debug('Found a started task: %r', vars(fact))
-                        for listener in self._listeners:
-                            listener.on_fact_started(fact)
-                    if fact.end_time is not None and last <= fact.end_time < now:
-                        logger.debug('Found a stopped task: %r', vars(fact))
-                        for listener in self._listeners:
-                            listener.on_fact_stopped(fact)
-                time.sleep(polling_intervall)
+            # allow the worker thread to run while the main loop waits
+            gobject.threads_init()
+            self._worker = threading.Thread(target=self._notify_listeners, name='hamster-bridge-listeners')
+            # a second interrupt must not be blocked by a hanging listener
+            self._worker.daemon = True
+            self._worker.start()
+            self.connect('facts-changed', self._on_hamster_facts_changed)
+            self.process()
+            self._base_polling_intervall = polling_intervall
+            self._schedule_polling(polling_intervall)
+            gobject.MainLoop().run()
         except (KeyboardInterrupt, SystemExit):
             pass
+        if self._worker is not None:
+            logger.debug('Waiting for listeners to handle the queued events')
+            self._events.put(None)
+            try:
+                # joining with timeout keeps the wait interruptible
+                while self._worker.is_alive():
+                    self._worker.join(1)
+            except (KeyboardInterrupt, SystemExit):
+                pass
@@ -3,6 +3,7 @@ import os
 
 import logging
 import re
+import time
 
 from hamster_bridge.listeners import (
     HamsterListener,
@@ -13,6 +14,23 @@ from hamster_bridge.listeners import (
 logger = logging.getLogger(__name__)
 
 
+def _import_redmine():
+    """
+    Imports python-redmine lazily as it is an optional dependency.
+    Prefers python-redmine >= 2.0 (package "redminelib") as it talks to Redmine through a persistent requests session
+    with HTTP keep-alive, while older versions open a new connection for each API call.
+
+    :returns: the python-redmine package
+    :rtype: module
+    """
+    try:
+        import redminelib
+        return redminelib
+    except ImportError:
+        import redmine
+        return redmine
+
+
 class RedmineHamsterListener(HamsterListener):
     """
     Redmine listener for hamster tasks,
@@ -56,7 +74,13 @@ class RedmineHamsterListener(HamsterListener):
     ]
 
     # Redmine issue key is just a number
-    issue_from_title = re.compile('([0-9]+)\ ')
+    issue_from_title = re.compile(r'([0-9]+) ')
+
+    # maximum number of activity strings whose issue candidates are memoized
+    issue_candidates_cache_size = 256
+
+    # seconds an issue lookup (also an unsuccessful one) is reused before asking Redmine again
+    issue_cache_ttl = 300
 
     def __init__(self):
         """
@@ -71,9 +95,120 @@ class RedmineHamsterListener(HamsterListener):
         # the redmine instance
         self.redmine = None
 
+        # the python-redmine package, resolved once in prepare()
+        self.__redmine_lib = None
+
+        # whether to start issues automatically, read from the config once in prepare()
+        self.__auto_start = False
+
         # will store the activities
         self.__activities = {}
 
+        # memoized issue candidates per activity string
+        self.__issue_candidates = {}
+
+        # cached issue lookups: issue id -> (lookup timestamp, issue or None if not existing)
+        self.__issues = {}
+
+    def __get_issue_candidates(self, activity):
+        """
+        Returns the possible issue ids found in the given activity string.
+        The result is memoized as the same activity is usually seen when starting and again when stopping a fact.
+
+        :param activity: the activity of a fact
+        :type activity: unicode
+        :returns: the possible issue ids in order of appearance
+        :rtype: tuple
+        """
+        try:
+            return self.__issue_candidates[activity]
+        except KeyError:
+            if len(self.__issue_candidates) >= self.issue_candidates_cache_size:
+                self.__issue_candidates.clear()
+            candidates = tuple(self.issue_from_title.findall(activity))
+            self.__issue_candidates[activity] = candidates
+            return candidates
+
+    def __is_issue_cached(self, issue_id):
+        """
+        Returns whether there is a lookup of the given issue id not older than issue_cache_ttl.
+
+        :param issue_id: the issue id
+        :type issue_id: str
+        :rtype: bool
+        """
+        try:
+            return time.time() - self.__issues[issue_id][0] < self.issue_cache_ttl
+        except KeyError:
+            return False
+
+    def __lookup_issues(self, issue_ids):
+        """
+        Looks up several issues with a single request and caches the results.
+        If the Redmine server does not support filtering by issue id, nothing is cached and the issues are looked up
+        one by one later on.
+
+        :param issue_ids: the issue ids
+        :type issue_ids: list
+        """
+        now = time.time()
+        try:
+            # status_id='*' as otherwise only open issues are returned, the limit keeps it to a single page even if
+            # the server ignores the issue_id filter
+            found = dict(
+                (issue.id, issue)
+                for issue in self.redmine.issue.filter(
+                    issue_id=','.join(issue_ids),
+                    status_id='*',
+                    limit=len(issue_ids),
+                )
+            )
+        except (self.__redmine_lib.exceptions.BaseRedmineError, IOError):
+            logger.debug('Unable to look up issues %s at once', issue_ids, exc_info=True)
+            return
+
+        wanted = set(int(issue_id) for issue_id in issue_ids)
+        if not set(found).issubset(wanted):
+            # the filter was ignored by the server
+            logger.debug('Redmine server does not support looking up issues %s at once', issue_ids)
+            return
+
+        for issue_id in issue_ids:
+            self.__issues[issue_id] = (now, found.get(int(issue_id)))
+
+    def __get_issue(self, issue_id):
+        """
+        Returns the issue with the given id, using the cached lookup if it is not older than issue_cache_ttl.
+
+        :param issue_id: the issue id
+        :type issue_id: str
+        :returns: the issue or None if it does not exist
+        :rtype: redmine.resources.Issue
+        """
+        now = time.time()
+        try:
+            looked_up, issue = self.__issues[issue_id]
+            if now - looked_up < self.issue_cache_ttl:
+                return issue
+        except KeyError:
+            pass
+
+        try:
+            issue = self.redmine.issue.get(issue_id)
+        except self.__redmine_lib.exceptions.ResourceNotFoundError:
+            issue = None
+        self.__issues[issue_id] = (now, issue)
+        return issue
+
+    def __invalidate_issue(self, issue):
+        """
+        Drops the cached lookup of the given issue after it was changed.
+
+        :param issue: the changed issue
+        :type issue: redmine.resources.Issue
+        """
+        self.__issues.pop(str(issue.id), None)
+
     def __get_issue_from_fact(self, fact):
         """
         Tries to find an issue matching the given fact.
@@ -83,14 +218,28 @@ class RedmineHamsterListener(HamsterListener):
         :returns: the issue or None if not found
         :rtype:
         """
-        from redmine.exceptions import ResourceNotFoundError
-        
+        candidates = self.__get_issue_candidates(fact.activity)
+
+        # short-circuit on the first possible issue known to exist, as long as all before are known to not exist
+        for possible_issue in candidates:
+            if not self.__is_issue_cached(possible_issue):
+                break
+            issue = self.__get_issue(possible_issue)
+            if issue is not None:
+                return issue
+        else:
+            return None
+
+        # look up all possible issues not cached yet with a single request
+        uncached = [possible_issue for possible_issue in candidates if not self.__is_issue_cached(possible_issue)]
+        if len(uncached) > 1:
+            self.__lookup_issues(uncached)
+
         # iterate the possible issues, normally this should match exactly one...
-        for possible_issue in self.issue_from_title.findall(fact.activity):
-            try:
-                return self.redmine.issue.get(possible_issue)
-            except ResourceNotFoundError:
-                return None
+        for possible_issue in candidates:
+            issue = self.__get_issue(possible_issue)
+            if issue is not None:
+                return issue
 
         return None
 
@@ -98,35 +247,31 @@ class RedmineHamsterListener(HamsterListener):
         """
         Filters the issue statuses for the relevant ones: the default and the status "In Work".
         """
-
-        def find_default(element):
-            """
-            Filter function to find the default issue status.
-            """
-            return hasattr(element, 'is_default') and getattr(element, 'is_default', False)
-
-        def find_in_work(element):
-            """
-            Filter function to find the in work status.
-            """
-            return element.name in [u'In Bearbeitung', u'In Work']
-
         # get the issue statuses
-        issue_statuses = self.redmine.issue_status.all()
+        try:
+            issue_statuses = list(self.redmine.issue_status.all())
+        except (self.__redmine_lib.exceptions.BaseRedmineError, IOError):
+            logger.exception('Unable to fetch issue statuses!')
+            return
 
-        # if none are found, raise
         if len(issue_statuses) == 0:
-            logger.exception('Unable to fetch issue statuses! Not possible to proceed!')
+            logger.error('Unable to fetch issue statuses!')
+            return
 
-        try:
-            self.__issue_status_default = [item for item in issue_statuses if find_default(item)][0]
-        except IndexError:
-            logger.exception('Unable to find a single default issue status!')
+        # python-redmine raises on unknown attributes, hasattr() swallows that
+        self.__issue_status_default = next(
+            (item for item in issue_statuses if hasattr(item, 'is_default') and item.is_default),
+            None,
+        )
+        if self.__issue_status_default is None:
+            logger.error('Unable to find a single default issue status!')
 
-        try:
-            self.__issue_status_in_work = [item for item in issue_statuses if find_in_work(item)][0]
-        except IndexError:
-            logger.exception('Unable to find a single "In Work" issue status!')
+        self.__issue_status_in_work = next(
+            (item for item in issue_statuses if item.name in (u'In Bearbeitung', u'In Work')),
+            None,
+        )
+        if self.__issue_status_in_work is None:
+            logger.error('Unable to find a single "In Work" issue status!')
 
     def __get_first_activity_id(self):
         """
@@ -164,11 +309,10 @@ class RedmineHamsterListener(HamsterListener):
     def prepare(self):
         """
         Prepares the listener by checking connectivity to configured Redmine instance.
-        While doing so, grabs the issue statuses, too, used for on_fact_stopped.
+        While doing so, grabs the issue statuses, too, if they are needed to auto start issues in on_fact_started.
         """
-        from redmine import Redmine
-        from redmine.exceptions import BaseRedmineError
-        
+        self.__redmine_lib = redmine = _import_redmine()
+
         verify_ssl = self.get_from_config('verify_ssl')
         requests_dict = {}
         if verify_ssl.lower() in ('y', 'true'):
@@ -187,8 +331,10 @@ class RedmineHamsterListener(HamsterListener):
                 "with default CA path", verify_ssl)
             requests_dict['verify'] = True
 
+        self.__auto_start = self.get_from_config('auto_start') == 'y'
+
         # setup the redmine instance
-        self.redmine = Redmine(
+        self.redmine = redmine.Redmine(
             self.get_from_config('server_url'),
             key=self.get_from_config('api_key'),
             version=self.get_from_config('version'),
@@ -202,14 +348,21 @@ class RedmineHamsterListener(HamsterListener):
             logger.info('### Available Redmine activities for using as tag value:')
             is_first = True
             for tea in time_entry_activities:
-                self.__activities[tea.id] = (tea.name, is_first)
+                name = tea.name
+                self.__activities[tea.id] = (name, is_first)
                 is_first = False
-                logger.info('### ' + tea.name)
-        except (BaseRedmineError, IOError):
+                logger.info('### %s', name)
+            logger.debug('Loaded %d activities', len(self.__activities))
+        except (redmine.exceptions.BaseRedmineError, IOError):
             logger.exception('Unable to communicate with redmine server. See error in the following output:')
 
         # fetch all available issue statuses and filter the default and in work ones as they are the only relevant statuses here
-        self.__filter_issue_statuses()
+        if self.__auto_start:
+            self.__filter_issue_statuses()
+            # no need to look up issues for started facts if their status can't be changed anyway
+            if self.__issue_status_default is None or self.__issue_status_in_work is None:
+                logger.error('Disabling auto start as the required issue statuses are unknown')
+                self.__auto_start = False
 
     def on_fact_started(self, fact):
         """
@@ -221,21 +374,24 @@ class RedmineHamsterListener(HamsterListener):
         :type fact: hamster.lib.stuff.Fact
         """
         # if issue shall be auto started...
-        auto_start = self.get_from_config('auto_start')
-        if auto_start == 'y':
-            # fetch the issue from the hamster fact
-            issue = self.__get_issue_from_fact(fact)
-
-            # abort if no issue was found
-            if not issue:
-                logger.error('Unable to query issue for starting of hamster fact %s', fact.original_activity)
-                return
-
-            # if the issue is in the default state (aka the initial state), put it into work state
-            if issue.status.id == self.__issue_status_default.id:
-                logger.info('setting status to "In Work" for issue %d', issue.id)
-                issue.status_id = self.__issue_status_in_work.id
-                issue.save()
+        if self.__auto_start:
+            try:
+                # fetch the issue from the hamster fact
+                issue = self.__get_issue_from_fact(fact)
+
+                # abort if no issue was found
+                if not issue:
+                    logger.error('Unable to query issue for starting of hamster fact %s', fact.original_activity)
+                    return
+
+                # if the issue is in the default state (aka the initial state), put it into work state
+                if issue.status.id == self.__issue_status_default.id:
+                    logger.info('setting status to "In Work" for issue %d', issue.id)
+                    issue.status_id = self.__issue_status_in_work.id
+                    issue.save()
+                    self.__invalidate_issue(issue)
+            except (self.__redmine_lib.exceptions.BaseRedmineError, IOError):
+                logger.exception('Error communicating with Redmine')
 
     def on_fact_stopped(self, fact):
         """
@@ -246,20 +402,23 @@ class RedmineHamsterListener(HamsterListener):
         :param fact: the currently stopped fact
         :type fact: hamster.lib.stuff.Fact
         """
+        try:
+            # fetch the issue from the hamster fact
+            issue = self.__get_issue_from_fact(fact)
 
-        # fetch the issue from the hamster fact
-        issue = self.__get_issue_from_fact(fact)
-
-        # abort if no issue was found
-        if not issue:
-            logger.error('Unable to query issue for stopping of hamster fact %s', fact.original_activity)
-            return
+            # abort if no issue was found
+            if not issue:
+                logger.error('Unable to query issue for stopping of hamster fact %s', fact.original_activity)
+                return
 
-        # create the time entry
-        self.redmine.time_entry.create(
-            issue_id=issue.id,
-            hours='%0.2f' % (fact.delta.total_seconds() / 3600.0),
-            # grep the tags, convert to string (the values are dbus.String) and find an activity
-            activity_id=self.__get_activity_id([str(tag) for tag in fact.tags]),
-            comments=fact.description,
-        )
+            # create the time entry
+            self.redmine.time_entry.create(
+                issue_id=issue.id,
+                hours='%0.2f' % (fact.delta.total_seconds() / 3600.0),
+                # grep the tags, convert to string (the values are dbus.String) and find an activity
+                activity_id=self.__get_activity_id([str(tag) for tag in fact.tags]),
+                comments=fact.description,
+            )
+            self.__invalidate_issue(issue)
+        except (self.__redmine_lib.exceptions.BaseRedmineError, IOError):
+            logger.exception('Error communicating with Redmine')